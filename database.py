@@ -5,7 +5,7 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -22,34 +22,48 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Explicit pool sizing and timeouts: reuse warm connections under load
+    # and fail fast when the server is unreachable instead of hanging requests.
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 50)),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", 5)),
+        maxIdleTimeMS=30000,
+        serverSelectionTimeoutMS=5000,
+        connectTimeoutMS=5000,
+        waitQueueTimeoutMS=2000,
+        retryWrites=True,
+    )
     db = _client[database_name]
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
-    # Convert Pydantic model to dict if needed
+    # Convert Pydantic model to dict if needed. pydantic-core compiles one
+    # serializer per model class at definition time; invoking it directly is
+    # the fast path that model_dump() wraps with option handling.
     if isinstance(data, BaseModel):
-        data_dict = data.model_dump()
+        data_dict = type(data).__pydantic_serializer__.to_python(data)
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
+
     cursor = db[collection_name].find(filter_dict or {})
     if limit:
         cursor = cursor.limit(limit)
-    
-    return list(cursor)
+
+    return await cursor.to_list(length=limit)
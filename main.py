@@ -1,43 +1,93 @@
 import os
 import hashlib
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Query
+import hmac
+import logging
+import ssl
+import time
+from datetime import datetime, timezone
+from typing import List, Literal, Optional
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, EmailStr, Field, HttpUrl
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 
 from database import db, create_document, get_documents
-from schemas import User as UserSchema, Listing as ListingSchema, Message as MessageSchema, Saved as SavedSchema
+from schemas import User as UserSchema, Listing as ListingSchema
 
-app = FastAPI(title="FluxMarket API", version="1.0.0")
+app = FastAPI(title="FluxMarket API", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Allow-list computed once at import; set CORS_ORIGINS to a comma-separated
+# list of origins in production, the wildcard is only the local-dev default.
+_cors_origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=_cors_origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
 )
 
+# Compress listing/thread payloads; tiny responses are left alone so they
+# don't pay the gzip overhead for no wire savings.
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 
 # Utils
-class ObjectIdStr(str):
-    @classmethod
-    def validate(cls, v: str) -> str:
-        try:
-            ObjectId(v)
-            return v
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid id")
+# Bound once so the per-request checks are a direct C call, not an attribute chain
+_is_valid_id = ObjectId.is_valid
+
+def require_valid_ids(*ids: str, detail: str = "Invalid ids") -> None:
+    """Validate a batch of ObjectId strings in one pass."""
+    if not all(map(_is_valid_id, ids)):
+        raise HTTPException(status_code=400, detail=detail)
+
+# Bound at module scope to skip the attribute lookup on every call; CPython's
+# hashlib delegates to OpenSSL, which uses SHA-NI instructions when the CPU has them.
+_sha256 = hashlib.sha256
 
 def sha256(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return _sha256(text.encode("utf-8")).hexdigest()
+
+# Argon2id parameters per RFC 9106 / OWASP recommendations
+ph = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=4)
+
+logger = logging.getLogger(__name__)
+
+@app.on_event("startup")
+def log_hash_backend():
+    assert "sha256" in hashlib.algorithms_guaranteed
+    logger.info("hashlib backend: %s", ssl.OPENSSL_VERSION)
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    await db.listing.create_index(
+        [("title", "text"), ("description", "text")],
+        weights={"title": 10, "description": 2},
+    )
+    await db.listing.create_index([("status", 1), ("category", 1)])
+    # B-tree index backing the anchored-prefix regex fallback in list_listings
+    await db.listing.create_index("title")
+    await db.user.create_index("email", unique=True)
+    await db.saved.create_index([("user_id", 1), ("listing_id", 1)], unique=True)
+    await db.saved.create_index("user_id")
+    await db.message.create_index(
+        [("listing_id", 1), ("from_user_id", 1), ("to_user_id", 1), ("created_at", 1)]
+    )
 
 
 # Auth Endpoints
 class RegisterBody(BaseModel):
     name: str
-    email: str
+    email: EmailStr
     password: str
     location: Optional[str] = None
 
@@ -45,79 +95,162 @@ class LoginBody(BaseModel):
     email: str
     password: str
 
-@app.post("/api/auth/register")
-def register(body: RegisterBody):
-    # check existing
-    existing = db.user.find_one({"email": body.email})
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
+# Throttle auth attempts before any hash work is scheduled; password
+# hashing is deliberately expensive, so unauthenticated clients must not
+# be able to queue unbounded hashing. Login is keyed per IP+email so a
+# remote attacker cannot exhaust a victim's budget; register per client IP.
+_AUTH_WINDOW = 60.0
+_AUTH_MAX_ATTEMPTS = 10
+_AUTH_TABLE_MAX = 10000
+_auth_attempts = {}
+
+def _check_auth_rate(key: str) -> None:
+    now = time.monotonic()
+    window_start, count = _auth_attempts.get(key, (now, 0))
+    if now - window_start > _AUTH_WINDOW:
+        window_start, count = now, 0
+    if count >= _AUTH_MAX_ATTEMPTS:
+        raise HTTPException(status_code=429, detail="Too many attempts, try again later")
+    if key not in _auth_attempts and len(_auth_attempts) >= _AUTH_TABLE_MAX:
+        # Bound memory by dropping expired windows; live counters are never
+        # wiped, so flooding the table cannot reset an active limit.
+        for k, (ws, _) in list(_auth_attempts.items()):
+            if now - ws > _AUTH_WINDOW:
+                del _auth_attempts[k]
+        if len(_auth_attempts) >= _AUTH_TABLE_MAX:
+            # Every entry is still inside its window: fail closed for new
+            # keys instead of evicting live counters an attacker wants gone.
+            # Self-heals within one window as entries expire.
+            raise HTTPException(status_code=429, detail="Too many attempts, try again later")
+    _auth_attempts[key] = (window_start, count + 1)
 
-    user = UserSchema(
+@app.post("/api/auth/register")
+async def register(body: RegisterBody, request: Request):
+    _check_auth_rate("register:" + (request.client.host if request.client else ""))
+    # Argon2 hashing is CPU-bound; keep it off the event loop
+    password_hash = await run_in_threadpool(ph.hash, body.password)
+    # Fields were already validated by RegisterBody's compiled validator;
+    # model_construct skips running UserSchema's validator a second time.
+    user = UserSchema.model_construct(
         name=body.name,
         email=body.email,
-        password_hash=sha256(body.password),
+        password_hash=password_hash,
         location=body.location,
         avatar_url=None,
         is_active=True,
     )
-    user_id = create_document("user", user)
+    try:
+        user_id = await create_document("user", user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     return {"id": user_id, "name": user.name, "email": user.email}
 
 @app.post("/api/auth/login")
-def login(body: LoginBody):
-    user = db.user.find_one({"email": body.email})
-    if not user or user.get("password_hash") != sha256(body.password):
+async def login(body: LoginBody, request: Request):
+    client_ip = request.client.host if request.client else ""
+    _check_auth_rate("login:" + client_ip + ":" + body.email)
+    user = await db.user.find_one({"email": body.email}, {"name": 1, "email": 1, "password_hash": 1})
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    stored = user.get("password_hash") or ""
+    if stored.startswith("$argon2"):
+        try:
+            await run_in_threadpool(ph.verify, stored, body.password)
+        except VerifyMismatchError:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        if ph.check_needs_rehash(stored):
+            new_hash = await run_in_threadpool(ph.hash, body.password)
+            await db.user.update_one({"_id": user["_id"]}, {"$set": {"password_hash": new_hash}})
+    else:
+        # legacy SHA-256 hash (64 hex chars); upgrade to Argon2id on successful login
+        if not hmac.compare_digest(stored, sha256(body.password)):
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+        new_hash = await run_in_threadpool(ph.hash, body.password)
+        await db.user.update_one({"_id": user["_id"]}, {"$set": {"password_hash": new_hash}})
+
     return {"id": str(user["_id"]), "name": user["name"], "email": user["email"]}
 
 
 # Listings Endpoints
+# Project only the fields clients render; skips decoding/shipping updated_at
+_LISTING_PROJECTION = {
+    "user_id": 1, "title": 1, "description": 1, "price": 1, "category": 1,
+    "listing_type": 1, "location": 1, "images": 1, "status": 1, "created_at": 1,
+}
+# Mirrors ListingSchema's constraints so the body validator is the only
+# validation pass on the way into the database.
 class CreateListingBody(BaseModel):
     user_id: str
-    title: str
-    description: str
-    price: float
+    title: str = Field(..., max_length=140)
+    description: str = Field(..., max_length=5000)
+    price: float = Field(..., ge=0)
     category: str
-    listing_type: str = "sale"
+    listing_type: Literal['sale', 'service', 'rent'] = 'sale'
     location: Optional[str] = None
-    images: Optional[List[str]] = []
+    images: List[HttpUrl] = Field(default_factory=list)
 
 @app.get("/api/listings")
-def list_listings(q: Optional[str] = None, category: Optional[str] = None, limit: int = Query(20, ge=1, le=100)):
+async def list_listings(
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    after: Optional[str] = None,
+):
     filter_q = {"status": "active"}
     if category:
         filter_q["category"] = category
-    if q:
-        # Simple text search via regex
-        filter_q["title"] = {"$regex": q, "$options": "i"}
-    docs = db.listing.find(filter_q).limit(limit)
-    listings = []
-    for d in docs:
+    text_search = bool(q) and not q.startswith("^")
+    if after and not text_search:
+        # Keyset pagination: resume below the last _id seen, an O(log N)
+        # index seek regardless of how deep the client has paged.
+        require_valid_ids(after, detail="Invalid cursor")
+        filter_q["_id"] = {"$lt": ObjectId(after)}
+    if q and not text_search:
+        # Anchored prefix match walks the title B-tree index; must stay
+        # case-sensitive, a case-insensitive regex is never index-eligible
+        filter_q["title"] = {"$regex": q}
+        docs = db.listing.find(filter_q, _LISTING_PROJECTION).sort("_id", -1).limit(limit)
+    elif q:
+        # Inverted text index instead of a regex collection scan; ordered by
+        # relevance score, so the _id keyset cursor does not apply here
+        filter_q["$text"] = {"$search": q}
+        docs = (
+            db.listing.find(filter_q, {**_LISTING_PROJECTION, "score": {"$meta": "textScore"}})
+            .sort([("score", {"$meta": "textScore"})])
+            .limit(limit)
+        )
+    else:
+        docs = db.listing.find(filter_q, _LISTING_PROJECTION).sort("_id", -1).limit(limit)
+    # One bulk fetch instead of a per-document round-trip through the event loop
+    listings = await docs.to_list(length=limit)
+    for d in listings:
         d["id"] = str(d.pop("_id"))
-        listings.append(d)
-    return {"items": listings}
+    next_cursor = listings[-1]["id"] if not text_search and len(listings) == limit else None
+    # Trusted output straight from our own projection; returning the response
+    # object skips FastAPI's jsonable_encoder pass over every document
+    return ORJSONResponse({"items": listings, "next": next_cursor})
 
 @app.post("/api/listings")
-def create_listing(body: CreateListingBody):
+async def create_listing(body: CreateListingBody):
     # ensure owner exists
-    if not ObjectId.is_valid(body.user_id):
-        raise HTTPException(status_code=400, detail="Invalid user id")
-    owner = db.user.find_one({"_id": ObjectId(body.user_id)})
+    require_valid_ids(body.user_id, detail="Invalid user id")
+    owner = await db.user.find_one({"_id": ObjectId(body.user_id)}, {"_id": 1})
     if not owner:
         raise HTTPException(status_code=404, detail="User not found")
 
-    listing = ListingSchema(
+    listing = ListingSchema.model_construct(
         user_id=body.user_id,
         title=body.title,
         description=body.description,
         price=body.price,
         category=body.category,
-        listing_type=body.listing_type if body.listing_type in ["sale", "service", "rent"] else "sale",
+        listing_type=body.listing_type,
         location=body.location,
-        images=body.images or [],
+        images=body.images,
         status="active",
     )
-    listing_id = create_document("listing", listing)
+    listing_id = await create_document("listing", listing)
     return {"id": listing_id}
 
 
@@ -127,108 +260,150 @@ class SaveBody(BaseModel):
     listing_id: str
 
 @app.post("/api/saved")
-def save_listing(body: SaveBody):
-    if not (ObjectId.is_valid(body.user_id) and ObjectId.is_valid(body.listing_id)):
-        raise HTTPException(status_code=400, detail="Invalid ids")
-
-    existing = db.saved.find_one({"user_id": body.user_id, "listing_id": body.listing_id})
-    if existing:
+async def save_listing(body: SaveBody):
+    require_valid_ids(body.user_id, body.listing_id)
+
+    # Atomic upsert: one round-trip whether or not the save already exists.
+    # Ids are stored as ObjectId so the unique index compares 12-byte keys,
+    # not 24-char strings.
+    now = datetime.now(timezone.utc)
+    result = await db.saved.update_one(
+        {"user_id": ObjectId(body.user_id), "listing_id": ObjectId(body.listing_id)},
+        {"$setOnInsert": {"created_at": now, "updated_at": now}},
+        upsert=True,
+    )
+    if result.upserted_id is None:
         return {"status": "already_saved"}
-
-    saved = SavedSchema(user_id=body.user_id, listing_id=body.listing_id)
-    saved_id = create_document("saved", saved)
-    return {"id": saved_id}
+    return {"id": str(result.upserted_id)}
 
 @app.get("/api/saved/{user_id}")
-def get_saved(user_id: str):
-    if not ObjectId.is_valid(user_id):
-        raise HTTPException(status_code=400, detail="Invalid user id")
-    docs = db.saved.find({"user_id": user_id})
-    result = []
-    for d in docs:
+async def get_saved(user_id: str, limit: int = Query(50, ge=1, le=200), after: Optional[str] = None):
+    require_valid_ids(user_id, detail="Invalid user id")
+    filter_q = {"user_id": ObjectId(user_id)}
+    if after:
+        # Same keyset cursor scheme as list_listings
+        require_valid_ids(after, detail="Invalid cursor")
+        filter_q["_id"] = {"$lt": ObjectId(after)}
+    docs = (
+        db.saved.find(filter_q, {"user_id": 1, "listing_id": 1, "created_at": 1})
+        .sort("_id", -1)
+        .limit(limit)
+    )
+    result = await docs.to_list(length=limit)
+    for d in result:
         d["id"] = str(d.pop("_id"))
-        result.append(d)
-    return {"items": result}
+        d["user_id"] = str(d["user_id"])
+        d["listing_id"] = str(d["listing_id"])
+    next_cursor = result[-1]["id"] if len(result) == limit else None
+    return ORJSONResponse({"items": result, "next": next_cursor})
 
 
 # Messaging
+# Short-lived positive cache for the per-message listing existence check.
+# Listings are rarely deleted, so a 60s window trades negligible staleness
+# for skipping a find_one on every message in an active thread.
+_LISTING_EXISTS_TTL = 60.0
+_LISTING_EXISTS_MAX = 1024
+_listing_exists_cache = {}
+
+async def _listing_exists(listing_id: str) -> bool:
+    now = time.monotonic()
+    expires = _listing_exists_cache.get(listing_id)
+    if expires is not None and expires > now:
+        return True
+    found = await db.listing.find_one({"_id": ObjectId(listing_id)}, {"_id": 1}) is not None
+    if found:
+        if len(_listing_exists_cache) >= _LISTING_EXISTS_MAX:
+            _listing_exists_cache.clear()
+        _listing_exists_cache[listing_id] = now + _LISTING_EXISTS_TTL
+    return found
+
 class SendMessageBody(BaseModel):
     listing_id: str
     from_user_id: str
     to_user_id: str
-    content: str
+    content: str = Field(..., max_length=5000)
 
 @app.post("/api/messages")
-def send_message(body: SendMessageBody):
-    if not (ObjectId.is_valid(body.listing_id) and ObjectId.is_valid(body.from_user_id) and ObjectId.is_valid(body.to_user_id)):
-        raise HTTPException(status_code=400, detail="Invalid ids")
+async def send_message(body: SendMessageBody):
+    require_valid_ids(body.listing_id, body.from_user_id, body.to_user_id)
     # ensure listing exists
-    if not db.listing.find_one({"_id": ObjectId(body.listing_id)}):
+    if not await _listing_exists(body.listing_id):
         raise HTTPException(status_code=404, detail="Listing not found")
 
-    msg = MessageSchema(
-        listing_id=body.listing_id,
-        from_user_id=body.from_user_id,
-        to_user_id=body.to_user_id,
-        content=body.content,
-        read=False,
-    )
-    msg_id = create_document("message", msg)
+    # Stored with ObjectId keys so thread queries probe the compound index
+    # with typed 12-byte values instead of string comparisons
+    msg_id = await create_document("message", {
+        "listing_id": ObjectId(body.listing_id),
+        "from_user_id": ObjectId(body.from_user_id),
+        "to_user_id": ObjectId(body.to_user_id),
+        "content": body.content,
+        "read": False,
+    })
     return {"id": msg_id}
 
 @app.get("/api/messages/thread")
-def get_thread(listing_id: str, a: str, b: str, limit: int = Query(50, ge=1, le=200)):
+async def get_thread(listing_id: str, a: str, b: str, limit: int = Query(50, ge=1, le=200)):
     # messages between user a and b about listing
-    if not (ObjectId.is_valid(listing_id) and ObjectId.is_valid(a) and ObjectId.is_valid(b)):
-        raise HTTPException(status_code=400, detail="Invalid ids")
-    docs = db.message.find({
-        "listing_id": listing_id,
-        "$or": [
-            {"from_user_id": a, "to_user_id": b},
-            {"from_user_id": b, "to_user_id": a},
-        ],
-    }).sort("created_at", 1).limit(limit)
-    out = []
-    for d in docs:
+    require_valid_ids(listing_id, a, b)
+    listing_oid, a_oid, b_oid = ObjectId(listing_id), ObjectId(a), ObjectId(b)
+    docs = db.message.find(
+        {
+            "listing_id": listing_oid,
+            "$or": [
+                {"from_user_id": a_oid, "to_user_id": b_oid},
+                {"from_user_id": b_oid, "to_user_id": a_oid},
+            ],
+        },
+        {"listing_id": 1, "from_user_id": 1, "to_user_id": 1, "content": 1, "read": 1, "created_at": 1},
+    ).sort("created_at", 1).limit(limit)
+    out = await docs.to_list(length=limit)
+    for d in out:
         d["id"] = str(d.pop("_id"))
-        out.append(d)
-    return {"items": out}
+        d["listing_id"] = str(d["listing_id"])
+        d["from_user_id"] = str(d["from_user_id"])
+        d["to_user_id"] = str(d["to_user_id"])
+    return ORJSONResponse({"items": out})
 
 
 @app.get("/")
 def read_root():
     return {"message": "FluxMarket backend running"}
 
-@app.get("/test")
-def test_database():
-    response = {
-        "backend": "✅ Running",
-        "database": "❌ Not Available",
-        "database_url": None,
-        "database_name": None,
-        "connection_status": "Not Connected",
-        "collections": []
-    }
-    try:
-        if db is not None:
-            response["database"] = "✅ Available"
-            response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
-            response["connection_status"] = "Connected"
-            try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
-                response["database"] = "✅ Connected & Working"
-            except Exception as e:
-                response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
-        else:
-            response["database"] = "⚠️ Available but not initialized"
-    except Exception as e:
-        response["database"] = f"❌ Error: {str(e)[:50]}"
-    return response
+# Diagnostics endpoint leaks deployment details; only register it when
+# explicitly enabled (e.g. ENABLE_DIAGNOSTICS=1 in a dev environment).
+if os.getenv("ENABLE_DIAGNOSTICS", "").lower() in ("1", "true", "yes"):
+    @app.get("/test")
+    async def test_database():
+        response = {
+            "backend": "✅ Running",
+            "database": "❌ Not Available",
+            "database_url": None,
+            "database_name": None,
+            "connection_status": "Not Connected",
+            "collections": []
+        }
+        try:
+            if db is not None:
+                response["database"] = "✅ Available"
+                response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
+                response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
+                response["connection_status"] = "Connected"
+                try:
+                    collections = await db.list_collection_names()
+                    response["collections"] = collections[:10]
+                    response["database"] = "✅ Connected & Working"
+                except Exception as e:
+                    response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
+            else:
+                response["database"] = "⚠️ Available but not initialized"
+        except Exception as e:
+            response["database"] = f"❌ Error: {str(e)[:50]}"
+        return response
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools")
@@ -12,7 +12,7 @@ from pydantic import BaseModel, Field, HttpUrl, EmailStr
 class User(BaseModel):
     name: str = Field(..., description="Full name")
     email: EmailStr = Field(..., description="Email address")
-    password_hash: str = Field(..., description="SHA-256 hash of password")
+    password_hash: str = Field(..., description="Argon2id hash of password (legacy SHA-256 accepted on login)")
     avatar_url: Optional[HttpUrl] = Field(None, description="Profile avatar URL")
     location: Optional[str] = Field(None, description="City or region")
     is_active: bool = Field(True, description="Whether user is active")
@@ -29,7 +29,9 @@ class Listing(BaseModel):
     images: List[HttpUrl] = Field(default_factory=list)
     status: Literal['active', 'sold', 'paused'] = Field('active')
 
-# Direct messages between buyer and seller tied to a listing
+# Direct messages between buyer and seller tied to a listing.
+# Id fields are the API-side string form; documents store them as ObjectId
+# so index probes compare 12-byte keys.
 class Message(BaseModel):
     listing_id: str
     from_user_id: str
@@ -37,7 +39,7 @@ class Message(BaseModel):
     content: str = Field(..., max_length=5000)
     read: bool = Field(False)
 
-# Saved/favorited listings per user
+# Saved/favorited listings per user; ids stored as ObjectId like Message
 class Saved(BaseModel):
     user_id: str
     listing_id: str